@@ -7,33 +7,56 @@ from BNF codes and analyze prescribing data by ICB.
 
 Production Considerations:
 - Add structured logging (e.g., using Python's logging module)
-- Implement retry logic with exponential backoff for API failures
-- Add response caching to reduce API calls and improve performance
+- Make the response cache location and TTL configurable
 - Respect rate limiting (check API documentation for limits)
 - Add monitoring/alerting for API failures
-- Consider using async requests for parallel API calls
 - Add circuit breaker pattern for API resilience
 """
 
+import os
 import sys
+import hashlib
+import threading
+import orjson
 import requests
 import argparse
+import functools
 from datetime import datetime
-from collections import defaultdict
+from collections import defaultdict, namedtuple
+from itertools import groupby
+from operator import attrgetter, itemgetter
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib3.util.retry import Retry
+
+try:
+    import requests_cache
+except ImportError:  # Optional: without it only the in-process cache is used
+    requests_cache = None
 
 
 # Configuration Constants
 API_BASE_URL = "https://openprescribing.net/api/1.0"
-API_TIMEOUT = 30  # seconds
+API_CONNECT_TIMEOUT = 3  # seconds
+API_READ_TIMEOUT = 10  # seconds
+API_TIMEOUT = (API_CONNECT_TIMEOUT, API_READ_TIMEOUT)
 BNF_CODE_LENGTH = 15
 CHEMICAL_CODE_LENGTH = 9
 CHEMICAL_CODE_ALT_LENGTH = 7  # Alternative length for edge cases
-MAX_RETRIES = 3
-RETRY_DELAY = 1  # seconds
+MAX_RETRIES = 3  # Total attempts per request
+RETRY_DELAY = 1  # seconds, doubled on each retry
+RETRY_STATUSES = (429, 500, 502, 503, 504)  # Transient server responses
+
+MAX_CONCURRENT_REQUESTS = 8  # Cap on in-flight API calls, to avoid rate limiting
+POOL_CONNECTIONS = 16
+POOL_MAXSIZE = MAX_CONCURRENT_REQUESTS
+CACHE_NAME = ".optool_cache"  # On-disk cache used when requests-cache is installed
+CACHE_TTL = 3600  # seconds
+RESPONSE_CACHE_SIZE = 1024  # In-process memoized responses
+# ETag-validated responses kept here when requests-cache is not installed
+ETAG_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "optool")
 
 # TODO: In production, these would come from environment variables or config file
 # API_KEY = os.environ.get('OPENPRESCRIBING_API_KEY')
-# CACHE_TTL = int(os.environ.get('CACHE_TTL', 3600))
 
 
 # Custom Exceptions
@@ -57,109 +80,234 @@ class InvalidInputError(OptoolError):
     pass
 
 
-def extract_chemical_code(bnf_code):
+# Data Structures
+# One ICB's prescribing for a month; only the fields the analysis uses are kept
+SpendingRow = namedtuple('SpendingRow', ['org_id', 'org_name', 'items'])
+# Parsed spending response: rows grouped by date plus the ICBs and dates seen
+SpendingData = namedtuple('SpendingData', ['by_date', 'org_ids', 'dates'])
+
+
+def _build_session():
     """
-    Extract the chemical substance code from a full BNF code.
+    Create a shared HTTP session so keep-alive connections are reused.
     
-    According to the BNF code structure:
-    - Full BNF code is 15 characters
-    - Chemical substance code is the first 9 characters
+    If requests-cache is installed, responses are also persisted on disk so
+    repeated runs for the same BNF code skip the network entirely.
+    
+    Transient failures (connection errors and RETRY_STATUSES) are retried
+    with exponential backoff by the adapter.
+    
+    Returns:
+        requests.Session: Session with a pooled, retrying HTTPS adapter mounted
+    """
+    if requests_cache is not None:
+        # Expired entries are revalidated with If-None-Match when they carry an ETag
+        session = requests_cache.CachedSession(
+            CACHE_NAME,
+            expire_after=CACHE_TTL,
+            cache_control=True
+        )
+    else:
+        session = requests.Session()
+    retries = Retry(
+        total=MAX_RETRIES - 1,
+        backoff_factor=RETRY_DELAY,
+        status_forcelist=RETRY_STATUSES,
+        # Use our own short backoff; a 429's Retry-After can be hours
+        respect_retry_after_header=False,
+        # Hand the final response back so raise_for_status() reports it
+        raise_on_status=False
+    )
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=POOL_CONNECTIONS,
+        pool_maxsize=POOL_MAXSIZE,
+        max_retries=retries
+    )
+    session.mount("https://", adapter)
+    session.headers.update({"Accept-Encoding": "gzip"})
+    return session
+
+
+# Shared session: avoids a fresh TCP + TLS handshake for every API call
+SESSION = _build_session()
+
+# Bounds in-flight requests across all worker threads
+_REQUEST_SLOTS = threading.BoundedSemaphore(MAX_CONCURRENT_REQUESTS)
+
+
+def _etag_cache_paths(api_url):
+    """
+    Get the files holding the cached ETag and body for a URL.
     
     Args:
-        bnf_code (str): The full 15-character BNF code
+        api_url (str): Full API URL including query parameters
         
     Returns:
-        str: The chemical substance code
+        tuple: (etag_path, body_path), or None if the ETag cache is disabled
+    """
+    if requests_cache is not None or not ETAG_CACHE_DIR:
+        return None
+    # One pair of files per URL, so concurrent requests never share a file
+    key = hashlib.sha256(api_url.encode()).hexdigest()
+    base = os.path.join(ETAG_CACHE_DIR, key)
+    return f"{base}.etag", f"{base}.json"
+
+
+def _read_etag_cache(paths):
+    """
+    Load a cached ETag and response body.
+    
+    Args:
+        paths (tuple): (etag_path, body_path) from _etag_cache_paths()
+        
+    Returns:
+        tuple: (etag, body), or None if nothing usable is cached
+    """
+    if paths is None:
+        return None
+    etag_path, body_path = paths
+    try:
+        with open(etag_path) as f:
+            etag = f.read()
+        with open(body_path, 'rb') as f:
+            body = f.read()
+    except OSError:
+        return None
+    return etag, body
+
+
+def _write_etag_cache(paths, etag, body):
+    """
+    Store an ETag and response body, ignoring any filesystem errors.
+    
+    Args:
+        paths (tuple): (etag_path, body_path) from _etag_cache_paths()
+        etag (str): ETag header returned by the API
+        body (bytes): Raw response body
+    """
+    if paths is None or not etag:
+        return
+    etag_path, body_path = paths
+    try:
+        os.makedirs(ETAG_CACHE_DIR, exist_ok=True)
+        # Write the body first so a stored ETag always has a matching body
+        with open(f"{body_path}.tmp", 'wb') as f:
+            f.write(body)
+        os.replace(f"{body_path}.tmp", body_path)
+        with open(etag_path, 'w') as f:
+            f.write(etag)
+    except OSError:
+        # Caching is best-effort; a failed write just means a full fetch next time
+        pass
+
+
+@functools.lru_cache(maxsize=RESPONSE_CACHE_SIZE)
+def _get_json(api_url):
+    """
+    Fetch and decode a JSON API response, memoized by URL.
+    
+    Without requests-cache, responses carrying an ETag are kept on disk and
+    revalidated with If-None-Match, so unchanged data comes back as a 304.
+    
+    Callers must treat the returned data as read-only, since the same
+    object is handed back for repeated requests.
+    
+    Args:
+        api_url (str): Full API URL including query parameters
+        
+    Returns:
+        list: Decoded JSON response
         
     Raises:
-        InvalidInputError: If BNF code is not exactly 15 characters
+        requests.RequestException: If the API request fails
+        ValueError: If the response is not valid JSON
     """
-    if len(bnf_code) != BNF_CODE_LENGTH:
-        raise InvalidInputError(
-            f"BNF code must be exactly {BNF_CODE_LENGTH} characters, got {len(bnf_code)}"
-        )
+    paths = _etag_cache_paths(api_url)
+    cached = _read_etag_cache(paths)
+    headers = {'If-None-Match': cached[0]} if cached else {}
+    
+    with _REQUEST_SLOTS:
+        response = SESSION.get(api_url, timeout=API_TIMEOUT, headers=headers)
+    
+    if cached and response.status_code == 304:
+        return orjson.loads(cached[1])
     
-    # TODO: In production, consider caching the results of check_code_exists
-    # to avoid repeated API calls for the same codes
+    response.raise_for_status()
     
-    # Try different lengths to handle edge cases
-    for length in [CHEMICAL_CODE_LENGTH, CHEMICAL_CODE_ALT_LENGTH]:
-        chemical_code = bnf_code[:length]
-        # Quick check if this code exists in the API
-        if check_code_exists(chemical_code):
-            return chemical_code
+    _write_etag_cache(paths, response.headers.get('ETag'), response.content)
     
-    # If no match found, default to standard length
-    # TODO: Log this scenario for monitoring unusual BNF codes
-    return bnf_code[:CHEMICAL_CODE_LENGTH]
+    # orjson parses the raw bytes directly, skipping the str decode
+    return orjson.loads(response.content)
 
 
-def check_code_exists(code):
+def extract_chemical_code(bnf_code):
     """
-    Check if a code exists in the API.
+    Extract the candidate chemical substance codes from a full BNF code.
+    
+    According to the BNF code structure:
+    - Full BNF code is 15 characters
+    - Chemical substance code is the first 9 characters
+    - Some edge cases only resolve at the 7-character level
     
     Args:
-        code (str): The code to check
+        bnf_code (str): The full 15-character BNF code
         
     Returns:
-        bool: True if the code exists, False otherwise
+        list: Candidate chemical codes, in order of preference
         
-    TODO: In production:
-    - Implement caching to avoid repeated lookups
-    - Add metrics/monitoring for API response times
+    Raises:
+        InvalidInputError: If BNF code is not exactly 15 characters
     """
-    api_url = f"{API_BASE_URL}/bnf_code/?format=json&exact=true&param={code}"
+    if len(bnf_code) != BNF_CODE_LENGTH:
+        raise InvalidInputError(
+            f"BNF code must be exactly {BNF_CODE_LENGTH} characters, got {len(bnf_code)}"
+        )
     
-    try:
-        response = requests.get(api_url, timeout=API_TIMEOUT)
-        response.raise_for_status()
-        data = response.json()
-        
-        # Check if we have any results with this exact ID
-        for item in data:
-            if item.get('id') == code:
-                return True
-        return False
-    except requests.RequestException:
-        # TODO: In production, log the specific error for debugging
-        # For now, assume code doesn't exist if we can't check
-        return False
+    return [bnf_code[:CHEMICAL_CODE_LENGTH], bnf_code[:CHEMICAL_CODE_ALT_LENGTH]]
 
 
-def get_chemical_name(chemical_code):
+def resolve_chemical(bnf_code):
     """
-    Look up the chemical name using the OpenPrescribing API.
+    Resolve a BNF code to its chemical code and name with a single API call.
+    
+    The shortest candidate code is sent as a prefix query, so the response
+    contains every candidate that exists and the preferred one can be picked
+    without probing each length separately.
     
     Args:
-        chemical_code (str): The 9-character chemical substance code
+        bnf_code (str): The full 15-character BNF code
         
     Returns:
-        str: The name of the chemical substance
+        tuple: (chemical_code, chemical_name)
         
     Raises:
+        InvalidInputError: If BNF code is not exactly 15 characters
         APIError: If the API request fails
-        DataNotFoundError: If no data found for the chemical code
+        DataNotFoundError: If no candidate code is found
     """
-    api_url = f"{API_BASE_URL}/bnf_code/?format=json&exact=true&q={chemical_code}"
+    candidates = extract_chemical_code(bnf_code)
+    api_url = f"{API_BASE_URL}/bnf_code/?format=json&q={candidates[-1]}"
     
     try:
-        # TODO: In production, implement retry logic with exponential backoff
-        response = requests.get(api_url, timeout=API_TIMEOUT)
-        response.raise_for_status()
-        
-        data = response.json()
+        data = _get_json(api_url)
         
         if not data:
-            raise DataNotFoundError(f"No data found for chemical code {chemical_code}")
+            raise DataNotFoundError(f"No data found for BNF code {bnf_code}")
         
-        # The API returns a list of matching codes
-        # We're looking for an exact match
-        for item in data:
-            if item.get('id') == chemical_code:
-                return item.get('name', 'Unknown chemical')
+        # Fast path: the preferred code is usually the first match
+        first = data[0]
+        if first.get('id') == candidates[0]:
+            return candidates[0], first.get('name', 'Unknown chemical')
+        
+        # The API returns every code matching the prefix
+        names = {item.get('id'): item.get('name', 'Unknown chemical') for item in data}
+        
+        for chemical_code in candidates:
+            if chemical_code in names:
+                return chemical_code, names[chemical_code]
         
         # If no exact match found, raise an error
-        raise DataNotFoundError(f"No exact match found for chemical code {chemical_code}")
+        raise DataNotFoundError(f"No exact match found for chemical code {candidates[0]}")
         
     except requests.RequestException as e:
         # TODO: In production, log full stack trace and request details
@@ -176,7 +324,8 @@ def get_spending_data(chemical_code):
         chemical_code (str): The chemical substance code
         
     Returns:
-        dict: Dictionary mapping dates to ICB spending data
+        SpendingData: by_date maps dates to lists of SpendingRow in date order,
+            org_ids is the set of ICB IDs seen and dates the sorted dates
         
     Raises:
         APIError: If the API request fails
@@ -186,32 +335,105 @@ def get_spending_data(chemical_code):
     - Add progress indicator for long-running requests
     - Consider streaming response for large datasets
     """
+    # spending_by_org has no column selection parameter, so full rows are
+    # downloaded and only the fields in SpendingRow are kept
     api_url = f"{API_BASE_URL}/spending_by_org/?format=json&org_type=icb&code={chemical_code}"
     
     try:
-        response = requests.get(api_url, timeout=API_TIMEOUT)
-        response.raise_for_status()
+        data = _get_json(api_url)
         
-        data = response.json()
+        # The API returns rows in date order, so this stable sort is a single
+        # linear pass and consecutive rows can be grouped without a hash map
+        rows = sorted((item for item in data if item.get('date')), key=itemgetter('date'))
         
-        # Organize data by date
-        spending_by_date = defaultdict(list)
+        # Organize data by date, collecting ICB IDs in the same pass
+        by_date = {}
+        org_ids = set()
         
-        for item in data:
-            date = item.get('date')
-            if date:
-                spending_by_date[date].append({
-                    'org_id': item.get('row_id'),
-                    'org_name': item.get('row_name'),
-                    'items': item.get('items', 0),
-                    'quantity': item.get('quantity', 0),
-                    'actual_cost': item.get('actual_cost', 0)
-                })
-        
-        return dict(spending_by_date)
+        for date, group in groupby(rows, key=itemgetter('date')):
+            date_rows = []
+            for item in group:
+                org_id = item.get('row_id')
+                org_ids.add(org_id)
+                date_rows.append(SpendingRow(
+                    org_id,
+                    item.get('row_name'),
+                    item.get('items', 0)
+                ))
+            by_date[date] = date_rows
+        
+        dates = list(by_date)
+        
+        return SpendingData(by_date, org_ids, dates)
         
     except requests.RequestException as e:
         raise APIError(f"Failed to fetch spending data from API: {e}")
+    except ValueError as e:
+        raise APIError(f"Failed to parse spending data from API: {e}")
+
+
+def _run_in_background(func, *args):
+    """
+    Run a function on a daemon thread and return a future for its result.
+    
+    Unlike executor threads, daemon threads are not joined at interpreter
+    exit, so an abandoned background request never delays an error exit.
+    
+    Args:
+        func (callable): Function to call
+        *args: Positional arguments for func
+        
+    Returns:
+        concurrent.futures.Future: Resolves to func's result or exception
+    """
+    future = Future()
+    
+    def run():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            result = func(*args)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+    
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+
+def fetch_chemical_and_spending(bnf_code):
+    """
+    Resolve a BNF code and fetch its spending data concurrently.
+    
+    Spending data for the usual 9-character chemical code is requested
+    speculatively while the chemical is being resolved, and is only
+    re-fetched if resolution settles on a different code.
+    
+    Args:
+        bnf_code (str): The full 15-character BNF code
+        
+    Returns:
+        tuple: (chemical_code, chemical_name, SpendingData)
+        
+    Raises:
+        InvalidInputError: If BNF code is not exactly 15 characters
+        APIError: If an API request fails
+        DataNotFoundError: If no candidate code is found
+    """
+    # Validate before issuing any requests
+    preferred_code = extract_chemical_code(bnf_code)[0]
+    
+    # If resolution fails the speculative fetch is abandoned, not waited on
+    spending_future = _run_in_background(get_spending_data, preferred_code)
+    chemical_code, chemical_name = resolve_chemical(bnf_code)
+    
+    if chemical_code == preferred_code:
+        spending_data = spending_future.result()
+    else:
+        spending_data = get_spending_data(chemical_code)
+    
+    return chemical_code, chemical_name, spending_data
 
 
 def find_top_prescriber_by_month(spending_data):
@@ -219,78 +441,175 @@ def find_top_prescriber_by_month(spending_data):
     Find the ICB with the most items prescribed for each month.
     
     Args:
-        spending_data (dict): Dictionary mapping dates to ICB spending data
+        spending_data (dict): Dictionary mapping dates to lists of SpendingRow, in date order
         
     Returns:
         list: List of tuples (date, icb_name) sorted by date
     """
     results = []
     
-    for date in sorted(spending_data.keys()):
-        icb_data = spending_data[date]
-        
+    for date, icb_data in spending_data.items():
         if not icb_data:
             continue
             
         # Find ICB with most items
         # If there's a tie, we take the first one (as returned by API)
-        top_icb = max(icb_data, key=lambda x: x['items'])
+        top_icb = max(icb_data, key=attrgetter('items'))
         
-        results.append((date, top_icb['org_name']))
+        results.append((date, top_icb.org_name))
     
     return results
 
 
-def get_icb_list_sizes(org_ids, dates):
+def _org_details_url(org_ids=None, year_month=None):
+    """
+    Build an org_details URL for ICB list sizes.
+    
+    Args:
+        org_ids (set): Optional set of ICB organization IDs; all ICBs if omitted
+        year_month (str): Optional month in YYYY-MM format; all months if omitted
+        
+    Returns:
+        str: The API URL
+    """
+    api_url = f"{API_BASE_URL}/org_details/?format=json&org_type=icb&keys=total_list_size"
+    if org_ids:
+        # Sorted so the same set of orgs always maps to the same cached URL
+        api_url += f"&org={','.join(sorted(org_ids))}"
+    if year_month:
+        api_url += f"&date={year_month}-01"
+    return api_url
+
+
+def _fetch_month_list_sizes(org_ids, year_month):
+    """
+    Fetch the list sizes of the given ICBs for a single month.
+    
+    Args:
+        org_ids (set): Set of ICB organization IDs
+        year_month (str): Month to query in YYYY-MM format
+        
+    Returns:
+        list: org_details records for the ICBs in that month
+        
+    Raises:
+        requests.RequestException: If the API request fails
+    """
+    return _get_json(_org_details_url(org_ids, year_month))
+
+
+def prefetch_icb_list_sizes():
+    """
+    Start fetching list sizes for every ICB and month in the background.
+    
+    This can begin before the spending data is known; the result is passed
+    to get_icb_list_sizes(), which keeps only the ICBs and dates it needs.
+    The request runs on a daemon thread, so exiting early never waits for it.
+    
+    Returns:
+        concurrent.futures.Future: Resolves to the raw org_details records
+    """
+    return _run_in_background(_get_json, _org_details_url())
+
+
+def get_icb_list_sizes(org_ids, dates, prefetched=None):
     """
     Get the total list sizes for ICBs for specific months.
     
+    Omitting the date from the org_details query returns every month in a
+    single response. If a prefetched all-ICB response is given, it is
+    filtered to the requested ICBs here; otherwise the query itself is
+    restricted to them with org=. If the API rejects the date-less query,
+    falls back to fetching each month separately.
+    
     Args:
         org_ids (set): Set of ICB organization IDs
         dates (list): List of dates to get list sizes for
+        prefetched (concurrent.futures.Future): Optional request started by
+            prefetch_icb_list_sizes(), used instead of a new request
         
     Returns:
         dict: Nested dictionary {date: {org_id: total_list_size}}
+    """
+    if not org_ids:
+        return {}
+    
+    try:
+        if prefetched is not None:
+            data = prefetched.result()
+        else:
+            data = _get_json(_org_details_url(org_ids))
+    except requests.HTTPError as e:
+        if e.response is not None and e.response.status_code == 400:
+            return _get_icb_list_sizes_by_month(org_ids, dates)
+        print(f"Warning: Failed to fetch list sizes: {e}", file=sys.stderr)
+        return {}
+    except (requests.RequestException, ValueError) as e:
+        # TODO: In production, log this error and track partial failures
+        print(f"Warning: Failed to fetch list sizes: {e}", file=sys.stderr)
+        return {}
+    
+    # Index the response by month, as the API may return a different day
+    sizes_by_month = defaultdict(dict)
+    for item in data:
+        org_id = item.get('row_id')
+        date = item.get('date')
+        if org_id in org_ids and date:
+            sizes_by_month[date[:7]][org_id] = item.get('total_list_size', 0)
+    
+    return {
+        date: dict(sizes_by_month[date[:7]])
+        for date in dates
+        if date[:7] in sizes_by_month
+    }
+
+
+def _get_icb_list_sizes_by_month(org_ids, dates):
+    """
+    Get the total list sizes for ICBs with one request per month.
+    
+    Months are fetched concurrently on a small thread pool sharing the
+    module-level session, so total latency is close to a single request.
+    
+    Args:
+        org_ids (set): Set of ICB organization IDs
+        dates (list): List of dates to get list sizes for
         
-    TODO: In production:
-    - Implement bulk fetching if API supports it
-    - Add caching with appropriate TTL
-    - Consider using async requests for parallel fetching
+    Returns:
+        dict: Nested dictionary {date: {org_id: total_list_size}}
     """
     list_sizes = defaultdict(dict)
     
-    # The org_details endpoint requires specific date parameters
-    # We'll need to query for each unique year/month combination
-    unique_months = set()
+    # Fallback for when the date-less bulk query returns 400:
+    # query each unique year/month combination separately
+    dates_by_month = defaultdict(list)
     for date in dates:
         # Extract year and month from date string (YYYY-MM-DD)
         year_month = date[:7]  # Gets YYYY-MM
-        unique_months.add(year_month)
+        dates_by_month[year_month].append(date)
     
-    for year_month in unique_months:
-        # Query for all ICBs for this month
-        api_url = f"{API_BASE_URL}/org_details/?format=json&org_type=icb&keys=total_list_size&date={year_month}-01"
-        
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+        futures = {
+            year_month: executor.submit(_fetch_month_list_sizes, org_ids, year_month)
+            for year_month in sorted(dates_by_month)
+        }
+    
+    for year_month, future in futures.items():
         try:
-            response = requests.get(api_url, timeout=API_TIMEOUT)
-            response.raise_for_status()
-            
-            data = response.json()
-            
-            # Store the list sizes for this month
-            for item in data:
-                org_id = item.get('row_id')
-                if org_id in org_ids:
-                    # The date in the response might be different, so we use our year_month
-                    for date in dates:
-                        if date.startswith(year_month):
-                            list_sizes[date][org_id] = item.get('total_list_size', 0)
-                            
-        except requests.RequestException as e:
+            data = future.result()
+        except (requests.RequestException, ValueError) as e:
             # Continue with partial data if some requests fail
             # TODO: In production, log this error and track partial failures
             print(f"Warning: Failed to fetch list sizes for {year_month}: {e}", file=sys.stderr)
             continue  # Skip this month and try the next one
+        
+        # Store the list sizes for this month
+        for item in data:
+            org_id = item.get('row_id')
+            if org_id in org_ids:
+                # The date in the response might be different, so we use our year_month
+                for date in dates_by_month[year_month]:
+                    list_sizes[date][org_id] = item.get('total_list_size', 0)
     
     return dict(list_sizes)
 
@@ -300,7 +619,7 @@ def find_top_prescriber_by_month_weighted(spending_data, list_sizes):
     Find the ICB with the most items prescribed per patient for each month.
     
     Args:
-        spending_data (dict): Dictionary mapping dates to ICB spending data
+        spending_data (dict): Dictionary mapping dates to lists of SpendingRow, in date order
         list_sizes (dict): Dictionary mapping dates to ICB list sizes
         
     Returns:
@@ -308,32 +627,25 @@ def find_top_prescriber_by_month_weighted(spending_data, list_sizes):
     """
     results = []
     
-    for date in sorted(spending_data.keys()):
-        icb_data = spending_data[date]
-        
+    for date, icb_data in spending_data.items():
         if not icb_data:
             continue
         
-        # Calculate items per patient for each ICB
+        # Get the list sizes for all ICBs on this date
+        date_list_sizes = list_sizes.get(date, {})
+        
+        # Calculate items per patient as (rate, org_name) pairs
         icb_rates = []
         for icb in icb_data:
-            org_id = icb['org_id']
-            items = icb['items']
-            
-            # Get the list size for this ICB on this date
-            list_size = list_sizes.get(date, {}).get(org_id, 0)
+            list_size = date_list_sizes.get(icb.org_id, 0)
             
             if list_size > 0:
-                rate = items / list_size
-                icb_rates.append({
-                    'org_name': icb['org_name'],
-                    'rate': rate
-                })
+                icb_rates.append((icb.items / list_size, icb.org_name))
         
         if icb_rates:
-            # Find ICB with highest rate
-            top_icb = max(icb_rates, key=lambda x: x['rate'])
-            results.append((date, top_icb['org_name']))
+            # Find ICB with highest rate; ties keep the first one
+            _, top_name = max(icb_rates, key=itemgetter(0))
+            results.append((date, top_name))
     
     return results
 
@@ -369,11 +681,14 @@ def main():
     args = parser.parse_args()
     
     try:
-        # Extract the chemical code from the full BNF code
-        chemical_code = extract_chemical_code(args.bnf_code)
+        # Validate before issuing any requests
+        extract_chemical_code(args.bnf_code)
         
-        # Look up the chemical name
-        chemical_name = get_chemical_name(chemical_code)
+        # List sizes don't depend on the chemical, so start fetching them now
+        list_sizes_future = prefetch_icb_list_sizes() if args.weighted else None
+        
+        # Resolve the chemical and fetch its spending data in parallel
+        chemical_code, chemical_name, spending_data = fetch_chemical_and_spending(args.bnf_code)
         
         # Print the chemical name
         print(chemical_name)
@@ -381,30 +696,22 @@ def main():
         # Part 2: Get spending data
         print()  # Empty line for separation
         
-        spending_data = get_spending_data(chemical_code)
-        
-        if not spending_data:
+        if not spending_data.by_date:
             print("No spending data found for this chemical.")
             sys.exit(0)
         
         if args.weighted:
             # Part 3: Weighted by population
-            # First, collect all unique org_ids and dates
-            org_ids = set()
-            dates = list(spending_data.keys())
-            
-            for date_data in spending_data.values():
-                for item in date_data:
-                    org_ids.add(item['org_id'])
-            
-            # Get list sizes for all ICBs
-            list_sizes = get_icb_list_sizes(org_ids, dates)
+            # Get list sizes for the ICBs and dates seen, from the prefetched response
+            list_sizes = get_icb_list_sizes(
+                spending_data.org_ids, spending_data.dates, list_sizes_future
+            )
             
             # Find top prescribers weighted by population
-            top_prescribers = find_top_prescriber_by_month_weighted(spending_data, list_sizes)
+            top_prescribers = find_top_prescriber_by_month_weighted(spending_data.by_date, list_sizes)
         else:
             # Part 2: Raw item counts
-            top_prescribers = find_top_prescriber_by_month(spending_data)
+            top_prescribers = find_top_prescriber_by_month(spending_data.by_date)
         
         # Print results
         for date, icb_name in top_prescribers:
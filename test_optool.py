@@ -1,20 +1,39 @@
+import os
+import sys
+import json
+import time
+import subprocess
+import threading
 import pytest
 from unittest.mock import patch, Mock, MagicMock
 import requests
+from concurrent.futures import ThreadPoolExecutor
+import optool
 from optool import (
     extract_chemical_code,
-    check_code_exists,
-    get_chemical_name,
+    resolve_chemical,
     get_spending_data,
+    fetch_chemical_and_spending,
     find_top_prescriber_by_month,
     find_top_prescriber_by_month_weighted,
     get_icb_list_sizes,
+    prefetch_icb_list_sizes,
+    main,
+    SpendingRow,
     InvalidInputError,  # Import the custom exception
     APIError,
     DataNotFoundError
 )
 
 # Test data fixtures
+@pytest.fixture(autouse=True)
+def clear_response_cache(monkeypatch):
+    """Ensure memoized API responses do not leak between tests."""
+    monkeypatch.setattr(optool, "ETAG_CACHE_DIR", None)
+    optool._get_json.cache_clear()
+    yield
+    optool._get_json.cache_clear()
+
 @pytest.fixture
 def sample_bnf_code():
     """A valid 15-character BNF code."""
@@ -90,144 +109,359 @@ def api_list_sizes_response():
         }
     ]
 
-# Tests for extract_chemical_code
-class TestExtractChemicalCode:
-    def test_valid_bnf_code_with_existing_9_char(self):
-        """Test extraction when 9-character code exists in API."""
-        with patch('optool.check_code_exists') as mock_check:
-            mock_check.return_value = True
-            result = extract_chemical_code("0101010G0AAABAB")
-            assert result == "0101010G0"
-            mock_check.assert_called_once_with("0101010G0")
+# Tests for _get_json
+class TestGetJson:
+    @patch('optool.SESSION.get')
+    def test_responses_are_memoized(self, mock_get, api_chemical_response):
+        """Test repeated requests for the same URL hit the API once."""
+        mock_response = Mock()
+        mock_response.content = json.dumps(api_chemical_response).encode()
+        mock_response.raise_for_status.return_value = None
+        mock_get.return_value = mock_response
+        
+        first = optool._get_json("https://example.test/api")
+        second = optool._get_json("https://example.test/api")
+        
+        assert first == second == api_chemical_response
+        assert mock_get.call_count == 1
+    
+    @patch('optool.SESSION.get')
+    def test_decodes_raw_bytes(self, mock_get, api_chemical_response):
+        """Test responses are parsed from bytes without a str decode."""
+        mock_response = Mock()
+        mock_response.content = json.dumps(api_chemical_response).encode()
+        mock_response.raise_for_status.return_value = None
+        mock_response.json.side_effect = AssertionError("response.json() should not be used")
+        type(mock_response).text = property(
+            lambda self: pytest.fail("response.text should not be used")
+        )
+        mock_get.return_value = mock_response
+        
+        assert optool._get_json("https://example.test/api") == api_chemical_response
+    
+    @patch('optool.SESSION.get')
+    def test_concurrency_is_bounded_across_pools(self, mock_get):
+        """Test in-flight requests stay capped when callers use separate pools."""
+        lock = threading.Lock()
+        in_flight = [0]
+        peak = [0]
+        
+        def side_effect(url, **kwargs):
+            with lock:
+                in_flight[0] += 1
+                peak[0] = max(peak[0], in_flight[0])
+            time.sleep(0.02)
+            with lock:
+                in_flight[0] -= 1
+            response = Mock(status_code=200, headers={})
+            response.content = b"[]"
+            response.raise_for_status.return_value = None
+            return response
+        
+        mock_get.side_effect = side_effect
+        
+        # Three pools, each as wide as the limit, with distinct URLs
+        executors = [
+            ThreadPoolExecutor(max_workers=optool.MAX_CONCURRENT_REQUESTS)
+            for _ in range(3)
+        ]
+        try:
+            futures = [
+                executor.submit(optool._get_json, f"https://example.test/api/{i}/{j}")
+                for i, executor in enumerate(executors)
+                for j in range(optool.MAX_CONCURRENT_REQUESTS)
+            ]
+            for future in futures:
+                future.result()
+        finally:
+            for executor in executors:
+                executor.shutdown()
+        
+        assert mock_get.call_count == 3 * optool.MAX_CONCURRENT_REQUESTS
+        assert peak[0] <= optool.MAX_CONCURRENT_REQUESTS
     
-    def test_valid_bnf_code_with_7_char_fallback(self):
-        """Test extraction falling back to 7-character code."""
-        with patch('optool.check_code_exists') as mock_check:
-            # First call (9 chars) returns False, second call (7 chars) returns True
-            mock_check.side_effect = [False, True]
-            result = extract_chemical_code("0101010G0AAABAB")
-            assert result == "0101010"
-            assert mock_check.call_count == 2
+    @patch('optool.SESSION.get')
+    def test_errors_are_not_memoized(self, mock_get, api_chemical_response):
+        """Test a failed request is retried on the next call."""
+        mock_response = Mock()
+        mock_response.content = json.dumps(api_chemical_response).encode()
+        mock_response.raise_for_status.return_value = None
+        mock_get.side_effect = [requests.RequestException("Network error"), mock_response]
+        
+        with pytest.raises(requests.RequestException):
+            optool._get_json("https://example.test/api")
+        assert optool._get_json("https://example.test/api") == api_chemical_response
+
+# Tests for the shared session
+class TestSession:
+    def test_adapter_retries_transient_failures(self):
+        """Test the HTTPS adapter retries with backoff on transient errors."""
+        retries = optool.SESSION.get_adapter("https://openprescribing.net").max_retries
+        
+        assert retries.total == optool.MAX_RETRIES - 1
+        assert retries.respect_retry_after_header is False
+        assert retries.backoff_factor == optool.RETRY_DELAY
+        assert 503 in retries.status_forcelist
+        assert 400 not in retries.status_forcelist
+
+# Tests for ETag revalidation
+class TestEtagCache:
+    @pytest.fixture(autouse=True)
+    def etag_cache_dir(self, monkeypatch, tmp_path):
+        """Enable the ETag cache in a temporary directory."""
+        monkeypatch.setattr(optool, "requests_cache", None)
+        monkeypatch.setattr(optool, "ETAG_CACHE_DIR", str(tmp_path))
     
-    def test_valid_bnf_code_default_to_9_chars(self):
-        """Test default to 9 characters when no match found."""
-        with patch('optool.check_code_exists') as mock_check:
-            mock_check.return_value = False
-            result = extract_chemical_code("0101010G0AAABAB")
-            assert result == "0101010G0"
+    @patch('optool.SESSION.get')
+    def test_not_modified_uses_cached_body(self, mock_get, api_chemical_response):
+        """Test a 304 response returns the body cached by an earlier run."""
+        first_response = Mock(status_code=200, headers={'ETag': '"abc"'})
+        first_response.content = json.dumps(api_chemical_response).encode()
+        first_response.raise_for_status.return_value = None
+        
+        not_modified = Mock(status_code=304, headers={})
+        mock_get.side_effect = [first_response, not_modified]
+        
+        assert optool._get_json("https://example.test/api") == api_chemical_response
+        
+        # Simulate a new run of the tool
+        optool._get_json.cache_clear()
+        assert optool._get_json("https://example.test/api") == api_chemical_response
+        
+        assert mock_get.call_args_list[0][1]['headers'] == {}
+        assert mock_get.call_args_list[1][1]['headers'] == {'If-None-Match': '"abc"'}
+    
+    @patch('optool.SESSION.get')
+    def test_changed_response_replaces_cache(self, mock_get):
+        """Test a 200 response after revalidation updates the cached body."""
+        responses = []
+        for etag, body in [('"v1"', [1]), ('"v2"', [2])]:
+            response = Mock(status_code=200, headers={'ETag': etag})
+            response.content = json.dumps(body).encode()
+            response.raise_for_status.return_value = None
+            responses.append(response)
+        mock_get.side_effect = responses
+        
+        assert optool._get_json("https://example.test/api") == [1]
+        optool._get_json.cache_clear()
+        assert optool._get_json("https://example.test/api") == [2]
+        
+        cached = optool._read_etag_cache(optool._etag_cache_paths("https://example.test/api"))
+        assert cached == ('"v2"', b"[2]")
+
+# Tests for extract_chemical_code
+class TestExtractChemicalCode:
+    def test_valid_bnf_code(self):
+        """Test candidate codes are returned longest first."""
+        result = extract_chemical_code("0101010G0AAABAB")
+        assert result == ["0101010G0", "0101010"]
     
     def test_invalid_length(self):
         """Test error raised for invalid BNF code length."""
         with pytest.raises(InvalidInputError, match="BNF code must be exactly 15 characters"):
             extract_chemical_code("12345")
 
-# Tests for check_code_exists
-class TestCheckCodeExists:
-    @patch('requests.get')
-    def test_code_exists(self, mock_get, api_chemical_response):
-        """Test when code exists in API."""
+# Tests for resolve_chemical
+class TestResolveChemical:
+    @patch('optool.SESSION.get')
+    def test_successful_lookup(self, mock_get, api_chemical_response):
+        """Test successful chemical resolution with a single API call."""
         mock_response = Mock()
-        mock_response.json.return_value = api_chemical_response
+        mock_response.content = json.dumps(api_chemical_response).encode()
         mock_response.raise_for_status.return_value = None
         mock_get.return_value = mock_response
         
-        result = check_code_exists("0101010G0")
-        assert result is True
+        result = resolve_chemical("0101010G0AAABAB")
+        assert result == ("0101010G0", "Co-Magaldrox_Susp 195mg/220mg/5ml S/F")
+        assert mock_get.call_count == 1
     
-    @patch('requests.get')
-    def test_code_not_exists(self, mock_get):
-        """Test when code doesn't exist in API."""
+    @patch('optool.SESSION.get')
+    def test_7_char_fallback(self, mock_get):
+        """Test falling back to the 7-character code."""
         mock_response = Mock()
-        mock_response.json.return_value = []
+        mock_response.content = json.dumps([{"id": "0101010", "name": "Short code chemical"}]).encode()
         mock_response.raise_for_status.return_value = None
         mock_get.return_value = mock_response
         
-        result = check_code_exists("0101010G0")
-        assert result is False
+        result = resolve_chemical("0101010G0AAABAB")
+        assert result == ("0101010", "Short code chemical")
     
-    @patch('requests.get')
-    def test_api_error(self, mock_get):
-        """Test handling of API errors."""
-        mock_get.side_effect = requests.RequestException("Network error")
-        result = check_code_exists("0101010G0")
-        assert result is False
-
-# Tests for get_chemical_name
-class TestGetChemicalName:
-    @patch('requests.get')
-    def test_successful_lookup(self, mock_get, api_chemical_response):
-        """Test successful chemical name lookup."""
+    @patch('optool.SESSION.get')
+    def test_prefers_9_char_code(self, mock_get, api_chemical_response):
+        """Test the 9-character code wins when both lengths exist."""
         mock_response = Mock()
-        mock_response.json.return_value = api_chemical_response
+        mock_response.content = json.dumps([{"id": "0101010", "name": "Short code chemical"}] + api_chemical_response).encode()
         mock_response.raise_for_status.return_value = None
         mock_get.return_value = mock_response
         
-        result = get_chemical_name("0101010G0")
-        assert result == "Co-Magaldrox_Susp 195mg/220mg/5ml S/F"
+        code, _ = resolve_chemical("0101010G0AAABAB")
+        assert code == "0101010G0"
     
-    @patch('requests.get')
+    @patch('optool.SESSION.get')
     def test_no_data_found(self, mock_get):
         """Test when no data is returned."""
         mock_response = Mock()
-        mock_response.json.return_value = []
+        mock_response.content = json.dumps([]).encode()
         mock_response.raise_for_status.return_value = None
         mock_get.return_value = mock_response
         
-        with pytest.raises(DataNotFoundError, match="No data found for chemical code"):
-            get_chemical_name("0101010G0")
+        with pytest.raises(DataNotFoundError, match="No data found for BNF code"):
+            resolve_chemical("0101010G0AAABAB")
     
-    @patch('requests.get')
+    @patch('optool.SESSION.get')
     def test_no_exact_match(self, mock_get):
         """Test when no exact match is found."""
         mock_response = Mock()
-        mock_response.json.return_value = [{"id": "0101010G1", "name": "Different chemical"}]
+        mock_response.content = json.dumps([{"id": "0101010G1", "name": "Different chemical"}]).encode()
         mock_response.raise_for_status.return_value = None
         mock_get.return_value = mock_response
         
         with pytest.raises(DataNotFoundError, match="No exact match found for chemical code"):
-            get_chemical_name("0101010G0")
+            resolve_chemical("0101010G0AAABAB")
     
-    @patch('requests.get')
+    @patch('optool.SESSION.get')
     def test_api_request_error(self, mock_get):
         """Test handling of API request errors."""
         mock_get.side_effect = requests.RequestException("Connection error")
         
         with pytest.raises(APIError, match="Failed to fetch data from API"):
-            get_chemical_name("0101010G0")
+            resolve_chemical("0101010G0AAABAB")
+    
+    @patch('optool.SESSION.get')
+    def test_invalid_json(self, mock_get):
+        """Test handling of a malformed API response."""
+        mock_response = Mock()
+        mock_response.content = b"<html>Server error</html>"
+        mock_response.raise_for_status.return_value = None
+        mock_get.return_value = mock_response
+        
+        with pytest.raises(APIError, match="Failed to parse API response"):
+            resolve_chemical("0101010G0AAABAB")
 
 # Tests for get_spending_data
 class TestGetSpendingData:
-    @patch('requests.get')
+    @patch('optool.SESSION.get')
     def test_successful_retrieval(self, mock_get, api_spending_response):
         """Test successful spending data retrieval."""
         mock_response = Mock()
-        mock_response.json.return_value = api_spending_response
+        mock_response.content = json.dumps(api_spending_response).encode()
         mock_response.raise_for_status.return_value = None
         mock_get.return_value = mock_response
         
         result = get_spending_data("0101010G0")
         
         # Verify the structure
-        assert "2023-01-01" in result
-        assert "2023-02-01" in result
-        assert len(result["2023-01-01"]) == 2
-        assert len(result["2023-02-01"]) == 2
+        assert "2023-01-01" in result.by_date
+        assert "2023-02-01" in result.by_date
+        assert len(result.by_date["2023-01-01"]) == 2
+        assert len(result.by_date["2023-02-01"]) == 2
+        assert result.org_ids == {"ICB001", "ICB002"}
+        assert result.dates == ["2023-01-01", "2023-02-01"]
         
         # Verify data transformation
-        jan_data = result["2023-01-01"]
-        assert jan_data[0]["org_id"] == "ICB001"
-        assert jan_data[0]["org_name"] == "NHS North East London ICB"
-        assert jan_data[0]["items"] == 150
-        assert jan_data[0]["quantity"] == 1500
-        assert jan_data[0]["actual_cost"] == 7500.50
+        jan_data = result.by_date["2023-01-01"]
+        assert jan_data[0] == SpendingRow("ICB001", "NHS North East London ICB", 150)
     
-    @patch('requests.get')
+    @patch('optool.SESSION.get')
+    def test_dates_are_sorted(self, mock_get, api_spending_response):
+        """Test dates are returned in order regardless of API order."""
+        mock_response = Mock()
+        mock_response.content = json.dumps(api_spending_response[::-1]).encode()
+        mock_response.raise_for_status.return_value = None
+        mock_get.return_value = mock_response
+        
+        result = get_spending_data("0101010G0")
+        
+        assert list(result.by_date) == ["2023-01-01", "2023-02-01"]
+        assert result.dates == ["2023-01-01", "2023-02-01"]
+    
+    @patch('optool.SESSION.get')
+    def test_interleaved_dates_are_grouped(self, mock_get, api_spending_response):
+        """Test rows for the same date are grouped even if not adjacent."""
+        jan_1, jan_2, feb_1, feb_2 = api_spending_response
+        mock_response = Mock()
+        mock_response.content = json.dumps([jan_1, feb_1, jan_2, feb_2]).encode()
+        mock_response.raise_for_status.return_value = None
+        mock_get.return_value = mock_response
+        
+        result = get_spending_data("0101010G0")
+        
+        assert [row.org_id for row in result.by_date["2023-01-01"]] == ["ICB001", "ICB002"]
+        assert [row.org_id for row in result.by_date["2023-02-01"]] == ["ICB001", "ICB002"]
+    
+    @patch('optool.SESSION.get')
     def test_api_error(self, mock_get):
         """Test handling of API errors."""
         mock_get.side_effect = requests.RequestException("API Error")
         
         with pytest.raises(APIError, match="Failed to fetch spending data from API"):
             get_spending_data("0101010G0")
+    
+    @patch('optool.SESSION.get')
+    def test_invalid_json(self, mock_get):
+        """Test handling of a malformed API response."""
+        mock_response = Mock()
+        mock_response.content = b"<html>Server error</html>"
+        mock_response.raise_for_status.return_value = None
+        mock_get.return_value = mock_response
+        
+        with pytest.raises(APIError, match="Failed to parse spending data from API"):
+            get_spending_data("0101010G0")
+
+# Tests for fetch_chemical_and_spending
+class TestFetchChemicalAndSpending:
+    def test_uses_speculative_spending_fetch(self):
+        """Test spending data for the 9-character code is reused."""
+        with patch('optool.resolve_chemical') as mock_resolve, \
+                patch('optool.get_spending_data') as mock_spending:
+            mock_resolve.return_value = ("0101010G0", "Chemical")
+            mock_spending.return_value = {"2023-01-01": []}
+            
+            result = fetch_chemical_and_spending("0101010G0AAABAB")
+            
+            assert result == ("0101010G0", "Chemical", {"2023-01-01": []})
+            mock_spending.assert_called_once_with("0101010G0")
+    
+    def test_refetches_for_7_char_code(self):
+        """Test spending data is re-fetched when the 7-character code is resolved."""
+        with patch('optool.resolve_chemical') as mock_resolve, \
+                patch('optool.get_spending_data') as mock_spending:
+            mock_resolve.return_value = ("0101010", "Chemical")
+            mock_spending.side_effect = lambda code: {code: []}
+            
+            result = fetch_chemical_and_spending("0101010G0AAABAB")
+            
+            assert result == ("0101010", "Chemical", {"0101010": []})
+            assert mock_spending.call_count == 2
+    
+    def test_resolution_error_not_delayed_by_spending_fetch(self):
+        """Test a resolution error is raised without waiting for spending data."""
+        release = threading.Event()
+        
+        def slow_spending(code):
+            release.wait(timeout=5)
+            return {}
+        
+        try:
+            with patch('optool.resolve_chemical') as mock_resolve, \
+                    patch('optool.get_spending_data', side_effect=slow_spending):
+                mock_resolve.side_effect = DataNotFoundError("No data found")
+                
+                start = time.monotonic()
+                with pytest.raises(DataNotFoundError):
+                    fetch_chemical_and_spending("0101010G0AAABAB")
+                elapsed = time.monotonic() - start
+        finally:
+            release.set()
+        
+        assert elapsed < 1
+    
+    def test_invalid_length(self):
+        """Test no requests are made for an invalid BNF code."""
+        with patch('optool.get_spending_data') as mock_spending:
+            with pytest.raises(InvalidInputError):
+                fetch_chemical_and_spending("12345")
+            mock_spending.assert_not_called()
 
 # Tests for find_top_prescriber_by_month
 class TestFindTopPrescriberByMonth:
@@ -235,12 +469,12 @@ class TestFindTopPrescriberByMonth:
         """Test finding top prescribers by item count."""
         spending_data = {
             "2023-01-01": [
-                {"org_id": "ICB001", "org_name": "ICB One", "items": 100},
-                {"org_id": "ICB002", "org_name": "ICB Two", "items": 200}
+                SpendingRow("ICB001", "ICB One", 100),
+                SpendingRow("ICB002", "ICB Two", 200)
             ],
             "2023-02-01": [
-                {"org_id": "ICB001", "org_name": "ICB One", "items": 150},
-                {"org_id": "ICB002", "org_name": "ICB Two", "items": 120}
+                SpendingRow("ICB001", "ICB One", 150),
+                SpendingRow("ICB002", "ICB Two", 120)
             ]
         }
         
@@ -259,8 +493,8 @@ class TestFindTopPrescriberByMonth:
         """Test tie-breaking (first one wins)."""
         spending_data = {
             "2023-01-01": [
-                {"org_id": "ICB001", "org_name": "ICB One", "items": 100},
-                {"org_id": "ICB002", "org_name": "ICB Two", "items": 100}
+                SpendingRow("ICB001", "ICB One", 100),
+                SpendingRow("ICB002", "ICB Two", 100)
             ]
         }
         
@@ -273,8 +507,8 @@ class TestFindTopPrescriberByMonthWeighted:
         """Test weighted calculation by population."""
         spending_data = {
             "2023-01-01": [
-                {"org_id": "ICB001", "org_name": "ICB One", "items": 100},
-                {"org_id": "ICB002", "org_name": "ICB Two", "items": 200}
+                SpendingRow("ICB001", "ICB One", 100),
+                SpendingRow("ICB002", "ICB Two", 200)
             ]
         }
         list_sizes = {
@@ -293,8 +527,8 @@ class TestFindTopPrescriberByMonthWeighted:
         """Test handling of missing list size data."""
         spending_data = {
             "2023-01-01": [
-                {"org_id": "ICB001", "org_name": "ICB One", "items": 100},
-                {"org_id": "ICB002", "org_name": "ICB Two", "items": 200}
+                SpendingRow("ICB001", "ICB One", 100),
+                SpendingRow("ICB002", "ICB Two", 200)
             ]
         }
         list_sizes = {
@@ -308,14 +542,32 @@ class TestFindTopPrescriberByMonthWeighted:
         # Should only include ICB with list size
         assert len(result) == 1
         assert result[0] == ("2023-01-01", "ICB One")
+    
+    def test_tie_breaking(self):
+        """Test tie-breaking on equal rates (first one wins)."""
+        spending_data = {
+            "2023-01-01": [
+                SpendingRow("ICB001", "ICB One", 100),
+                SpendingRow("ICB002", "ICB Two", 200)
+            ]
+        }
+        list_sizes = {
+            "2023-01-01": {
+                "ICB001": 10000,
+                "ICB002": 20000
+            }
+        }
+        
+        result = find_top_prescriber_by_month_weighted(spending_data, list_sizes)
+        assert result[0] == ("2023-01-01", "ICB One")  # First in list wins
 
 # Tests for get_icb_list_sizes
 class TestGetIcbListSizes:
-    @patch('requests.get')
+    @patch('optool.SESSION.get')
     def test_successful_retrieval(self, mock_get, api_list_sizes_response):
         """Test successful list sizes retrieval."""
         mock_response = Mock()
-        mock_response.json.return_value = api_list_sizes_response
+        mock_response.content = json.dumps(api_list_sizes_response).encode()
         mock_response.raise_for_status.return_value = None
         mock_get.return_value = mock_response
         
@@ -328,17 +580,92 @@ class TestGetIcbListSizes:
         assert result["2023-01-01"]["ICB001"] == 500000
         assert result["2023-01-01"]["ICB002"] == 800000
     
-    @patch('requests.get')
+    @patch('optool.SESSION.get')
+    def test_single_bulk_request(self, mock_get):
+        """Test all months are fetched with one request."""
+        mock_response = Mock()
+        mock_response.content = json.dumps([
+            {"row_id": "ICB001", "total_list_size": 500000, "date": "2023-01-01"},
+            {"row_id": "ICB001", "total_list_size": 510000, "date": "2023-02-01"},
+            {"row_id": "ICB003", "total_list_size": 900000, "date": "2023-02-01"}
+        ]).encode()
+        mock_response.raise_for_status.return_value = None
+        mock_get.return_value = mock_response
+        
+        result = get_icb_list_sizes({"ICB001"}, ["2023-01-01", "2023-02-01"])
+        
+        assert result == {
+            "2023-01-01": {"ICB001": 500000},
+            "2023-02-01": {"ICB001": 510000}
+        }
+        assert mock_get.call_count == 1
+        assert "date=" not in mock_get.call_args[0][0]
+    
+    @patch('optool.SESSION.get')
+    def test_query_restricted_to_orgs(self, mock_get, api_list_sizes_response):
+        """Test the requested ICBs are sent to the API."""
+        mock_response = Mock()
+        mock_response.content = json.dumps(api_list_sizes_response).encode()
+        mock_response.raise_for_status.return_value = None
+        mock_get.return_value = mock_response
+        
+        get_icb_list_sizes({"ICB002", "ICB001"}, ["2023-01-01"])
+        
+        assert "&org=ICB001,ICB002" in mock_get.call_args[0][0]
+    
+    @patch('optool.SESSION.get')
+    def test_prefetched_response(self, mock_get):
+        """Test a prefetched all-ICB response is filtered to the requested ICBs."""
+        mock_response = Mock()
+        mock_response.content = json.dumps([
+            {"row_id": "ICB001", "total_list_size": 500000, "date": "2023-01-01"},
+            {"row_id": "ICB003", "total_list_size": 900000, "date": "2023-01-01"}
+        ]).encode()
+        mock_response.raise_for_status.return_value = None
+        mock_get.return_value = mock_response
+        
+        future = prefetch_icb_list_sizes()
+        result = get_icb_list_sizes({"ICB001"}, ["2023-01-01"], future)
+        
+        assert result == {"2023-01-01": {"ICB001": 500000}}
+        assert mock_get.call_count == 1
+        assert "&org=" not in mock_get.call_args[0][0]
+    
+    @patch('optool.SESSION.get')
+    def test_no_orgs(self, mock_get):
+        """Test no request is made when there are no ICBs."""
+        assert get_icb_list_sizes(set(), ["2023-01-01"]) == {}
+        mock_get.assert_not_called()
+    
+    @patch('optool.SESSION.get')
+    def test_bulk_failure_handling(self, mock_get, capsys):
+        """Test a failed bulk request yields no list sizes and a warning."""
+        mock_get.side_effect = requests.RequestException("API Error")
+        
+        result = get_icb_list_sizes({"ICB001"}, ["2023-01-01"])
+        
+        assert result == {}
+        captured = capsys.readouterr()
+        assert "Warning: Failed to fetch list sizes" in captured.err
+    
+    @patch('optool.SESSION.get')
     def test_partial_failure_handling(self, mock_get, capsys):
-        """Test handling of partial API failures."""
-        # First call succeeds, second fails
+        """Test handling of partial API failures in the per-month fallback."""
+        # Bulk request is rejected, first month succeeds, second fails
+        bulk_response = Mock()
+        bulk_response.raise_for_status.side_effect = requests.HTTPError(
+            "Bad Request", response=Mock(status_code=400)
+        )
+        
         success_response = Mock()
-        success_response.json.return_value = [
+        success_response.content = json.dumps([
             {"row_id": "ICB001", "total_list_size": 500000}
-        ]
+        ]).encode()
         success_response.raise_for_status.return_value = None
         
         def side_effect(url, **kwargs):  # Accept keyword arguments
+            if "date=" not in url:
+                return bulk_response
             if "2023-01" in url:
                 return success_response
             else:
@@ -360,13 +687,13 @@ class TestGetIcbListSizes:
         captured = capsys.readouterr()
         assert "Warning: Failed to fetch list sizes" in captured.err
     
-    @patch('requests.get')
+    @patch('optool.SESSION.get')
     def test_multiple_months_same_year(self, mock_get):
         """Test handling multiple dates in same year-month."""
         mock_response = Mock()
-        mock_response.json.return_value = [
-            {"row_id": "ICB001", "total_list_size": 500000}
-        ]
+        mock_response.content = json.dumps([
+            {"row_id": "ICB001", "total_list_size": 500000, "date": "2023-01-01"}
+        ]).encode()
         mock_response.raise_for_status.return_value = None
         mock_get.return_value = mock_response
         
@@ -380,4 +707,57 @@ class TestGetIcbListSizes:
         assert all(result[date]["ICB001"] == 500000 for date in dates)
         
         # Should only make one API call
-        assert mock_get.call_count == 1
\ No newline at end of file
+        assert mock_get.call_count == 1
+
+# Tests for main
+MAIN_EXIT_SCRIPT = """
+import sys, time
+from unittest.mock import patch
+import optool
+
+def slow_get_json(api_url):
+    time.sleep(5)
+    return []
+
+sys.argv = ["optool.py", "--weighted", "0101010G0AAABAB"]
+with patch("optool._get_json", side_effect=slow_get_json), \\
+        patch("optool.resolve_chemical", **{resolve}), \\
+        patch("optool.get_spending_data", **{spending}):
+    optool.main()
+"""
+
+
+class TestMain:
+    @pytest.mark.parametrize("resolve, spending, returncode, expected", [
+        # Resolution fails while both background fetches are still running
+        (
+            'dict(side_effect=optool.APIError("Connection error"))',
+            'dict(side_effect=slow_get_json)',
+            1,
+            "API Error: Connection error"
+        ),
+        # Empty spending data exits while the list size prefetch is running
+        (
+            'dict(return_value=("0101010G0", "Chemical"))',
+            'dict(return_value=optool.SpendingData(dict(), set(), []))',
+            0,
+            "No spending data found"
+        ),
+    ])
+    def test_exit_not_delayed_by_background_fetches(self, resolve, spending, returncode, expected):
+        """Test the process exits without waiting for abandoned background requests."""
+        script = MAIN_EXIT_SCRIPT.format(resolve=resolve, spending=spending)
+        
+        start = time.monotonic()
+        result = subprocess.run(
+            [sys.executable, "-c", script],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            timeout=30
+        )
+        elapsed = time.monotonic() - start
+        
+        assert result.returncode == returncode, result.stderr
+        assert expected in result.stdout + result.stderr
+        assert elapsed < 3